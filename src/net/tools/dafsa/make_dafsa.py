@@ -25,11 +25,13 @@ the source node to the sink node.
 The following python represention is used for nodes:
 
   Source node: [ children ]
-  Internal node: (label, [ children ])
+  Internal node: InteriorNode(label, [ children ])
   Sink node: None
 
 The graph is first compressed by prefixes like a trie. In the next step
-suffixes are compressed so that the graph gets diamond shaped. Finally
+suffixes are compressed so that the graph gets diamond shaped. Both steps
+are done at once by adding the words in sorted order and merging the
+suffixes of a word as soon as no later word can extend them. Finally
 one to one linked nodes are replaced by nodes with the labels joined.
 
 The order of the operations is crucial since lookups will be performed
@@ -115,26 +117,26 @@ a, 2
 The input is first parsed to a list of words:
 ["aa1", "a2"]
 
-A fully expanded graph is created from the words:
-source = [node1, node4]
-node1 = ("a", [node2])
-node2 = ("a", [node3])
-node3 = ("\x01", [sink])
-node4 = ("a", [node5])
-node5 = ("\x02", [sink])
+The words are sorted by their labels, where the return value is the last
+label, and added to a graph with one node per character:
+source = [node1]
+node1 = InteriorNode("a", [node2, node3])
+node2 = InteriorNode("\x02", [sink])
+node3 = InteriorNode("a", [node4])
+node4 = InteriorNode("\x01", [sink])
 sink = None
 
 Compression results in the following graph:
 source = [node1]
-node1 = ("a", [node2, node3])
-node2 = ("\x02", [sink])
-node3 = ("a\x01", [sink])
+node1 = InteriorNode("a", [node2, node3])
+node2 = InteriorNode("\x02", [sink])
+node3 = InteriorNode("a\x01", [sink])
 sink = None
 
 A C++ representation of the compressed graph is generated:
 
 const unsigned char dafsa[7] = {
-  0x81, 0xE1, 0x02, 0x81, 0x82, 0x61, 0x81,
+  0x81, 0xE1, 0x02, 0x82, 0x61, 0x81, 0x82,
 };
 
 The bytes in the generated array has the following meaning:
@@ -143,12 +145,12 @@ The bytes in the generated array has the following meaning:
 
  1: 0xE1 <end_char>     label character (0xE1 & 0x7F) -> match "a"
  2: 0x02 <offset1>      child at position 2 + (0x02 & 0x3F) -> jump to 4
+ 3: 0x82 <end_offset1>  child at position 4 + (0x82 & 0x3F) -> jump to 6
 
- 3: 0x81 <end_offset1>  child at position 4 + (0x81 & 0x3F) -> jump to 5
- 4: 0x82 <return_value> 0x82 & 0x0F -> return 2
+ 4: 0x61 <char>         label character 0x61 -> match "a"
+ 5: 0x81 <return_value> 0x81 & 0x0F -> return 1
 
- 5: 0x61 <char>         label character 0x61 -> match "a"
- 6: 0x81 <return_value> 0x81 & 0x0F -> return 1
+ 6: 0x82 <return_value> 0x82 & 0x0F -> return 2
 
 Example 2:
 
@@ -163,48 +165,101 @@ The input is first parsed to a list of words:
 
 Compression results in the following graph:
 source = [node1, node2]
-node1 = ("b", [node2, node3])
-node2 = ("aa\x01", [sink])
-node3 = ("bb\x02", [sink])
+node1 = InteriorNode("aa\x01", [sink])
+node2 = InteriorNode("b", [node1, node3])
+node3 = InteriorNode("bb\x02", [sink])
 sink = None
 
 A C++ representation of the compressed graph is generated:
 
 const unsigned char dafsa[11] = {
-  0x02, 0x83, 0xE2, 0x02, 0x83, 0x61, 0x61, 0x81, 0x62, 0x62, 0x82,
+  0x02, 0x86, 0xE2, 0x02, 0x83, 0x62, 0x62, 0x82, 0x61, 0x61, 0x81,
 };
 
 The bytes in the generated array has the following meaning:
 
  0: 0x02 <offset1>      child at position 0 + (0x02 & 0x3F) -> jump to 2
- 1: 0x83 <end_offset1>  child at position 2 + (0x83 & 0x3F) -> jump to 5
+ 1: 0x86 <end_offset1>  child at position 2 + (0x86 & 0x3F) -> jump to 8
 
  2: 0xE2 <end_char>     label character (0xE2 & 0x7F) -> match "b"
  3: 0x02 <offset1>      child at position 3 + (0x02 & 0x3F) -> jump to 5
  4: 0x83 <end_offset1>  child at position 5 + (0x83 & 0x3F) -> jump to 8
 
- 5: 0x61 <char>         label character 0x61 -> match "a"
- 6: 0x61 <char>         label character 0x61 -> match "a"
- 7: 0x81 <return_value> 0x81 & 0x0F -> return 1
+ 5: 0x62 <char>         label character 0x62 -> match "b"
+ 6: 0x62 <char>         label character 0x62 -> match "b"
+ 7: 0x82 <return_value> 0x82 & 0x0F -> return 2
 
- 8: 0x62 <char>         label character 0x62 -> match "b"
- 9: 0x62 <char>         label character 0x62 -> match "b"
-10: 0x82 <return_value> 0x82 & 0x0F -> return 2
+ 8: 0x61 <char>         label character 0x61 -> match "a"
+ 9: 0x61 <char>         label character 0x61 -> match "a"
+10: 0x81 <return_value> 0x81 & 0x0F -> return 1
 """
 
 import argparse
+import hashlib
+import os
+import re
 import sys
+import tempfile
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+
+class InteriorNode:
+  """A labeled node with a list of children.
+
+  Besides the label and the children every node has a few scratch fields
+  which are used by the passes below to attach data to the node. A pass
+  restores the fields to their initial values when it is done.
+  """
+  __slots__ = ('label', 'children', 'pcount', 'incoming', 'canon', 'offset',
+               'mapped')
+
+  def __init__(self, label: str,
+               children: List[Optional['InteriorNode']]) -> None:
+    self.label = label
+    self.children = children
+    # Number of references to this node, used by join_labels.
+    self.pcount = 0
+    # Number of unvisited references to this node, used by top_sort.
+    self.incoming = 0
+    # Id of the matching node, used by build_minimal and join_suffixes.
+    self.canon = 0
+    # Position of this node in the reversed output, used by encode.
+    self.offset = 0
+    # The corresponding node in a new DAFSA, used while creating it.
+    self.mapped: Optional[InteriorNode] = None
+
+  def __eq__(self, other: object) -> bool:
+    if not isinstance(other, InteriorNode):
+      return NotImplemented
+    return self.label == other.label and self.children == other.children
+
+  # Nodes compare by value but are mutable, just like the lists they hold.
+  __hash__ = None  # type: ignore
+
+  def __repr__(self) -> str:
+    return 'InteriorNode(%r, %r)' % (self.label, self.children)
 
-from typing import Any, Dict, FrozenSet, Iterable, List, MutableSequence, Sequence, Tuple, Union
 
-# Use of Any below is because mypy doesn't support recursive types.
 SinkNode = Union[None, None]  # weird hack to get around lack of TypeAlias.
-InteriorNode = Tuple[str, List[Any]]
-SourceNode = List[Any]
+SourceNode = List[Optional[InteriorNode]]
+
+Node = Optional[InteriorNode]
+DAFSA = SourceNode
+
 
-NonSinkNode = Union[InteriorNode, SourceNode]
-Node = Union[SinkNode, InteriorNode, SourceNode]
-DAFSA = List[Node]
+# Matches words that consist of printable 7-bit ASCII characters only.
+PRINTABLE_ASCII = re.compile('[\x20-\x7f]*')
+
+# Matches a line of a gperf file with a domain name and a return value.
+GPERF_LINE = re.compile('(.*), ([0-7])')
+
+# Number of bytes of a link by the bit length of its distance. A link has 6,
+# 13 or 21 bits for the distance.
+LINK_SIZES = bytes([1] * 7 + [2] * 7 + [3] * 8)
+
+# Textual representation of every byte value in the generated C++ code.
+HEX_BYTES = ['0x%02x' % byte for byte in range(256)]
 
 
 class InputError(Exception):
@@ -222,45 +277,130 @@ def to_dafsa(words: Iterable[str]) -> DAFSA:
 
   def ToNodes(word: str) -> Node:
     """Split words into characters"""
-    if not 0x1F < ord(word[0]) < 0x80:
+    if not PRINTABLE_ASCII.fullmatch(word):
       raise InputError('Domain names must be printable 7-bit ASCII')
-    if len(word) == 1:
-      return chr(ord(word[0]) & 0x0F), [None]
-    return word[0], [ToNodes(word[1:])]
+    # The chain is built from the sink upwards so that no recursion is needed.
+    node = InteriorNode(chr(ord(word[-1]) & 0x0F), [None])
+    for c in reversed(word[:-1]):
+      node = InteriorNode(c, [node])
+    return node
   return [ToNodes(word) for word in words]
 
 
+def build_minimal(words: Iterable[str]) -> DAFSA:
+  """Generates a DAFSA with merged prefixes and suffixes from a word list and
+  returns the source nodes.
+
+  The words are added in sorted order, one node per character. Once a word
+  is added, the nodes of the previous word that are not shared with it can't
+  get any more children. Those nodes are then replaced by an equal node if
+  one exists, or registered otherwise. Two nodes are equal if they have the
+  same label and the same children. Thus the full trie is never created.
+  It is assumed the word list is not empty.
+  """
+  # The return value is turned into the last label of each word, so that a
+  # word is never a prefix of another word.
+  labels = set()
+  for word in words:
+    if not PRINTABLE_ASCII.fullmatch(word):
+      raise InputError('Domain names must be printable 7-bit ASCII')
+    labels.add(word[:-1] + chr(ord(word[-1]) & 0x0F))
+  if not labels:
+    raise InputError('The domain list must not be empty')
+
+  source: SourceNode = []
+  # Maps the label and the ids of the children to a registered node. Every
+  # registered node gets a positive id, the sink has id 0.
+  register: Dict[Tuple[str, Tuple[int, ...]], InteriorNode] = {}
+  # The nodes of the previously added word that are not registered yet.
+  path: List[InteriorNode] = []
+
+  def replace_or_register(length: int) -> None:
+    """Replaces or registers the unregistered nodes after `length`."""
+    while len(path) > length:
+      node = path.pop()
+      # Only the last node of a word links to the sink, as its only child.
+      if node.children[0] is None:
+        signature: Tuple[str, Tuple[int, ...]] = (node.label, (0, ))
+      else:
+        signature = (node.label,
+                     tuple([child.canon for child in node.children
+                            if child is not None]))
+      # The signature is only hashed once, whether the node is new or not.
+      match = register.setdefault(signature, node)
+      if match is node:
+        node.canon = len(register)
+      else:
+        (path[-1].children if path else source)[-1] = match
+
+  previous = ''
+  for word in sorted(labels):
+    common = 0
+    for c, p in zip(word, previous):
+      if c != p:
+        break
+      common += 1
+    replace_or_register(common)
+    children = path[-1].children if path else source
+    for c in word[common:]:
+      node = InteriorNode(c, [])
+      children.append(node)
+      path.append(node)
+      children = node.children
+    children.append(None)
+    previous = word
+  replace_or_register(0)
+
+  for node in register.values():
+    node.canon = 0
+  return source
+
+
 def to_words(node: Node) -> Iterable[str]:
   """Generates a word list from all paths starting from an internal node."""
-  if not node:
-    return ['']
-  return [(node[0] + word) for child in node[1] for word in to_words(child)]
+  words: List[str] = []
+  stack: List[Tuple[Node, str]] = [(node, '')]
+  while stack:
+    node, prefix = stack.pop()
+    if not node:
+      words.append(prefix)
+    else:
+      # Children are pushed in reverse so that words are generated in order.
+      prefix += node.label
+      stack.extend((child, prefix) for child in reversed(node.children))
+  return words
 
 
 def reverse(dafsa: DAFSA) -> DAFSA:
   """Generates a new DAFSA that is reversed, so that the old sink node becomes
   the new source node.
+
+  A new reverse node will be created for each old node. The new node will
+  get a reversed label and the parents of the old node as children. The graph
+  is visited in dfs order.
   """
   sink: SourceNode = []
-  nodemap: Dict[int, InteriorNode] = {}
-
-  def dfs(node: Node, parent: Node) -> None:
-    """Creates reverse nodes.
-
-    A new reverse node will be created for each old node. The new node will
-    get a reversed label and the parents of the old node as children.
-    """
-    if not node:
+  visited: List[InteriorNode] = []
+  # The nodes to visit and the new nodes of their parents are kept in two
+  # parallel stacks so that no pair is created for every link.
+  stack: List[Node] = dafsa[::-1]
+  parents: List[Node] = [None] * len(stack)
+
+  while stack:
+    node = stack.pop()
+    parent = parents.pop()
+    if node is None:
       sink.append(parent)
-    elif id(node) not in nodemap:
-      nodemap[id(node)] = (node[0][::-1], [parent])
-      for child in node[1]:
-        dfs(child, nodemap[id(node)])
+    elif node.mapped is None:
+      node.mapped = InteriorNode(node.label[::-1], [parent])
+      visited.append(node)
+      stack.extend(node.children[::-1])
+      parents.extend([node.mapped] * len(node.children))
     else:
-      nodemap[id(node)][1].append(parent)
+      node.mapped.children.append(parent)
 
-  for node in dafsa:
-    dfs(node, None)
+  for node in visited:
+    node.mapped = None
   return sink
 
 
@@ -268,201 +408,262 @@ def join_labels(dafsa: DAFSA) -> DAFSA:
   """Generates a new DAFSA where internal nodes are merged if there is a one to
   one connection.
   """
-  parentcount: Dict[int, int] = {id(None): 2}
-  nodemap: Dict[int, Node] = {id(None): None}
+  return join_labels_sorted(dafsa)[0]
 
-  def count_parents(node: Node) -> None:
-    """Count incoming references"""
-    if id(node) in parentcount:
-      parentcount[id(node)] += 1
-    else:
-      assert node is not None  # parentcount statically contains `id(None)`
-      parentcount[id(node)] = 1
-      for child in node[1]:
-        count_parents(child)
-
-  def join(node: Node) -> Node:
-    """Create new nodes"""
-    if id(node) not in nodemap:
-      assert node is not None  # nodemap statically contains `id(None)`
-      children = [join(child) for child in node[1]]
-      if len(children) == 1 and parentcount[id(node[1][0])] == 1:
-        child = children[0]
-        # parentcount statically maps `id(None)` to 2, so this child cannot be
-        # the sink.
-        assert child is not None
-        nodemap[id(node)] = (node[0] + child[0], child[1])
-      else:
-        nodemap[id(node)] = (node[0], children)
-    return nodemap[id(node)]
 
+def join_labels_sorted(
+    dafsa: DAFSA) -> Tuple[DAFSA, Sequence[InteriorNode]]:
+  """Same as join_labels, but also returns the nodes of the new DAFSA in
+  topological sort order.
+  """
+  nodes = top_sort(dafsa)
+
+  # Count incoming references. The sink is never counted, it can't be merged.
   for node in dafsa:
-    count_parents(node)
-  return [join(node) for node in dafsa]
+    if node is not None:
+      node.pcount += 1
+  for node in nodes:
+    for child in node.children:
+      if child is not None:
+        child.pcount += 1
+
+  # Create new nodes. Children are joined before their parents. A child that
+  # is joined into its parent gets a count of 0, it has no new node.
+  for node in reversed(nodes):
+    children = node.children
+    if len(children) == 1 and children[0] is not None and (
+        children[0].pcount == 1):
+      children[0].pcount = 0
+      child = children[0].mapped
+      assert child is not None
+      # Many joined labels are equal, so only keep one copy of each.
+      node.mapped = InteriorNode(sys.intern(node.label + child.label),
+                                 child.children)
+    else:
+      node.mapped = InteriorNode(node.label, [
+          child.mapped if child is not None else None for child in children
+      ])
+
+  joined = [node.mapped if node is not None else None for node in dafsa]
+  # The new nodes keep the order of the nodes they were created for.
+  joined_nodes: List[InteriorNode] = []
+  for node in nodes:
+    if node.pcount:
+      assert node.mapped is not None
+      joined_nodes.append(node.mapped)
+    node.pcount = 0
+    node.mapped = None
+  return joined, joined_nodes
 
 
 def join_suffixes(dafsa: DAFSA) -> DAFSA:
   """Generates a new DAFSA where nodes that represent the same word lists
   towards the sink are merged.
-  """
-  nodemap: Dict[FrozenSet[str], Node] = {frozenset(('', )): None}
 
-  def join(node: Node) -> Node:
-    """Returns a matching node. A new node is created if no matching node
-    exists. The graph is accessed in dfs order.
-    """
-    suffixes = frozenset(to_words(node))
-    if suffixes not in nodemap:
-      # The only set of suffixes for the sink is {''}, which is statically
-      # contained in nodemap.
-      assert node is not None
-      nodemap[suffixes] = (node[0], [join(child) for child in node[1]])
-    return nodemap[suffixes]
-
-  return [join(node) for node in dafsa]
-
-
-def top_sort(dafsa: DAFSA) -> Sequence[NonSinkNode]:
+  The graph is accessed in reverse topological order so that all children of
+  a node are merged before the node itself. Two nodes then represent the same
+  word lists if they have the same label and the same set of merged children.
+  A new node is created if no matching node exists.
+  """
+  # Maps a signature, the label and the sorted ids of the merged children, to
+  # the matching node. Every matching node gets a positive id, the sink has
+  # id 0.
+  nodemap: Dict[Tuple[str, Tuple[int, ...]], InteriorNode] = {}
+  nodes = top_sort(dafsa)
+
+  for node in reversed(nodes):
+    ids = [child.canon if child is not None else 0 for child in node.children]
+    if len(ids) > 1:
+      ids.sort()
+    signature = (node.label, tuple(ids))
+    match = nodemap.get(signature)
+    if match is None:
+      match = InteriorNode(node.label, [
+          child.mapped if child is not None else None
+          for child in node.children
+      ])
+      match.canon = len(nodemap) + 1
+      nodemap[signature] = match
+    node.canon = match.canon
+    node.mapped = match
+
+  joined = [node.mapped if node is not None else None for node in dafsa]
+  for node in nodes:
+    node.canon = 0
+    node.mapped = None
+  for node in nodemap.values():
+    node.canon = 0
+  return joined
+
+
+def top_sort(dafsa: DAFSA) -> Sequence[InteriorNode]:
   """Generates list of nodes in topological sort order."""
-  # `incoming` contains the in-degree of every node except the sink.
-  incoming: Dict[int, int] = {}
-
-  def count_incoming(node: Node) -> None:
-    """Counts incoming references."""
-    if node:
-      if id(node) not in incoming:
-        incoming[id(node)] = 1
-        for child in node[1]:
-          count_incoming(child)
-      else:
-        incoming[id(node)] += 1
-
-  for node in dafsa:
-    count_incoming(node)
-
+  # Count references from other nodes to every node except the sink. The
+  # count of a node starts at 1 when it is first reached so that visited
+  # nodes can be told apart, thus a node without references has a count of 1.
+  stack: List[InteriorNode] = []
   for node in dafsa:
-    if node:
-      incoming[id(node)] -= 1
+    if node and not node.incoming:
+      node.incoming = 1
+      stack.append(node)
+  while stack:
+    node = stack.pop()
+    for child in node.children:
+      if child:
+        if not child.incoming:
+          child.incoming = 1
+          stack.append(child)
+        child.incoming += 1
 
-  waiting: List[NonSinkNode] = [
-      node for node in dafsa if node and incoming[id(node)] == 0
+  waiting: List[InteriorNode] = [
+      node for node in dafsa if node and node.incoming == 1
   ]
-  nodes: List[NonSinkNode] = []
+  nodes: List[InteriorNode] = []
 
   while waiting:
     node = waiting.pop()
-    assert incoming[id(node)] == 0
+    assert node.incoming == 1
+    node.incoming = 0
     nodes.append(node)
-    for child in node[1]:
+    for child in node.children:
       if child:
-        incoming[id(child)] -= 1
-        if incoming[id(child)] == 0:
+        child.incoming -= 1
+        if child.incoming == 1:
           waiting.append(child)
   return nodes
 
 
-def encode_links(children: Sequence[Node], offsets: Dict[int, int],
-                 current: int) -> Iterable[int]:
+def link_size(distance: int) -> int:
+  """Returns the number of bytes needed to encode a link of a distance."""
+  assert distance > 0 and distance < (1 << 21)
+  return LINK_SIZES[distance.bit_length()]
+
+
+def encode_links(children: Sequence[Optional[InteriorNode]],
+                 current: int) -> bytearray:
   """Encodes a list of children as one, two or three byte offsets."""
-  if not children[0]:
+  first_child = children[0]
+  if first_child is None:
     # This is an <end_label> node and no links follow such nodes
     assert len(children) == 1
-    return []
-  guess = 3 * len(children)
-  assert children
-  children = sorted(children, key = lambda x: -offsets[id(x)])
-  while True:
-    offset = current + guess
-    buf: List[int] = []
-    for child in children:
-      last = len(buf)
-      distance = offset - offsets[id(child)]
-      assert distance > 0 and distance < (1 << 21)
-
-      if distance < (1 << 6):
-        # A 6-bit offset: "s0xxxxxx"
-        buf.append(distance)
-      elif distance < (1 << 13):
-        # A 13-bit offset: "s10xxxxxxxxxxxxx"
-        buf.append(0x40 | (distance >> 8))
-        buf.append(distance & 0xFF)
-      else:
-        # A 21-bit offset: "s11xxxxxxxxxxxxxxxxxxxxx"
-        buf.append(0x60 | (distance >> 16))
-        buf.append((distance >> 8) & 0xFF)
-        buf.append(distance & 0xFF)
-      # Distance in first link is relative to following record.
-      # Distance in other links are relative to previous link.
-      offset -= distance
-    if len(buf) == guess:
+    return bytearray()
+  # Distance in first link is relative to following record.
+  # Distance in other links are relative to previous link, so they don't
+  # depend on the size of the encoded links.
+  if len(children) == 1:
+    # Most nodes have a single child, there are no other links then.
+    distances: List[int] = []
+    first = current - first_child.offset
+  else:
+    nodes = sorted((child for child in children if child is not None),
+                   key = lambda x: -x.offset)
+    assert len(nodes) == len(children)
+    distances = [
+        prev.offset - child.offset
+        for prev, child in zip(nodes, nodes[1:])
+    ]
+    size = sum(link_size(distance) for distance in distances)
+    first = current + size - nodes[0].offset
+  # The first distance includes the size of the first link itself. Use the
+  # largest size that can encode the resulting distance.
+  for first_size in (3, 2, 1):
+    if link_size(first + first_size) == first_size:
       break
-    guess = len(buf)
+  distances.insert(0, first + first_size)
+
+  buf = bytearray()
+  for distance in distances:
+    last = len(buf)
+    assert distance > 0 and distance < (1 << 21)
+
+    if distance < (1 << 6):
+      # A 6-bit offset: "s0xxxxxx"
+      buf.append(distance)
+    elif distance < (1 << 13):
+      # A 13-bit offset: "s10xxxxxxxxxxxxx"
+      buf.append(0x40 | (distance >> 8))
+      buf.append(distance & 0xFF)
+    else:
+      # A 21-bit offset: "s11xxxxxxxxxxxxxxxxxxxxx"
+      buf.append(0x60 | (distance >> 16))
+      buf.append((distance >> 8) & 0xFF)
+      buf.append(distance & 0xFF)
   # Set most significant bit to mark end of links in this node.
   buf[last] |= (1 << 7)
-  buf.reverse()
-  return buf
+  return buf[::-1]
 
 
-def encode_prefix(label: str) -> MutableSequence[int]:
-  """Encodes a node label as a list of bytes without a trailing high byte.
+def encode_prefix(label: str) -> bytes:
+  """Encodes a node label as bytes without a trailing high byte.
 
   This method encodes a node if there is exactly one child  and the
   child follows immidiately after so that no jump is needed. This label
   will then be a prefix to the label in the child node.
   """
   assert label
-  return [ord(c) for c in reversed(label)]
+  return label.encode('ascii')[::-1]
 
 
-def encode_label(label: str) -> Iterable[int]:
-  """Encodes a node label as a list of bytes with a trailing high byte >0x80.
-  """
-  buf = encode_prefix(label)
+def encode_label(label: str) -> bytearray:
+  """Encodes a node label as bytes with a trailing high byte >0x80."""
+  buf = bytearray(encode_prefix(label))
   # Set most significant bit to mark end of label in this node.
   buf[0] |= (1 << 7)
   return buf
 
 
-def encode(dafsa: DAFSA) -> Sequence[int]:
-  """Encodes a DAFSA to a list of bytes"""
-  output: List[int] = []
-  offsets: Dict[int, int] = {}
+def encode(dafsa: DAFSA,
+           nodes: Optional[Sequence[InteriorNode]] = None) -> bytes:
+  """Encodes a DAFSA to bytes.
 
-  for node in reversed(top_sort(dafsa)):
-    if (len(node[1]) == 1 and node[1][0] and
-        (offsets[id(node[1][0])] == len(output))):
-      output.extend(encode_prefix(node[0]))
+  `nodes` are the nodes of the DAFSA in topological sort order. They are
+  sorted here if not given.
+  """
+  if nodes is None:
+    nodes = top_sort(dafsa)
+  # The output is generated backwards and reversed when done. It grows as
+  # needed, which measured faster than writing into a preallocated array.
+  output = bytearray()
+  extend = output.extend
+
+  for node in reversed(nodes):
+    children = node.children
+    if (len(children) == 1 and children[0] and
+        (children[0].offset == len(output))):
+      extend(encode_prefix(node.label))
     else:
-      output.extend(encode_links(node[1], offsets, len(output)))
-      output.extend(encode_label(node[0]))
-    offsets[id(node)] = len(output)
-
-  output.extend(encode_links(dafsa, offsets, len(output)))
+      extend(encode_links(children, len(output)))
+      extend(encode_label(node.label))
+    node.offset = len(output)
+
+  output.extend(encode_links(dafsa, len(output)))
+  for node in nodes:
+    node.offset = 0
+  # Reverse in place rather than into a copy of the whole output.
   output.reverse()
-  return output
+  return bytes(output)
 
 
 def to_cxx(data: Sequence[int]) -> str:
   """Generates C++ code from a list of encoded bytes."""
-  text = '/* This file is generated. DO NOT EDIT!\n\n'
-  text += 'The byte array encodes effective tld names. See make_dafsa.py for'
-  text += ' documentation.'
-  text += '*/\n\n'
-  text += 'const unsigned char kDafsa[%s] = {\n' % len(data)
+  text = ['/* This file is generated. DO NOT EDIT!\n\n'
+          'The byte array encodes effective tld names. See make_dafsa.py for'
+          ' documentation.'
+          '*/\n\n'
+          'const unsigned char kDafsa[%s] = {\n' % len(data)]
   for i in range(0, len(data), 12):
-    text += '  '
-    text += ', '.join('0x%02x' % byte for byte in data[i:i + 12])
-    text += ',\n'
-  text += '};\n'
-  return text
+    text.append('  ')
+    text.append(', '.join(HEX_BYTES[byte] for byte in data[i:i + 12]))
+    text.append(',\n')
+  text.append('};\n')
+  return ''.join(text)
 
 
 def words_to_cxx(words: Iterable[str]) -> str:
   """Generates C++ code from a word list"""
-  dafsa = to_dafsa(words)
-  for fun in (reverse, join_suffixes, reverse, join_suffixes, join_labels):
-    dafsa = fun(dafsa)
-  return to_cxx(encode(dafsa))
+  dafsa = build_minimal(words)
+  dafsa, nodes = join_labels_sorted(dafsa)
+  return to_cxx(encode(dafsa, nodes))
 
 
 def parse_gperf(infile: Iterable[str], reverse: bool) -> Iterable[str]:
@@ -472,18 +673,62 @@ def parse_gperf(infile: Iterable[str], reverse: bool) -> Iterable[str]:
   begin = lines.index('%%') + 1
   end = lines.index('%%', begin)
   lines = lines[begin:end]
+  words: List[Tuple[str, str]] = []
   for line in lines:
-    if line[-3:-1] != ', ':
-      raise InputError('Expected "domainname, <digit>", found "%s"' % line)
-    # Technically the DAFSA format can support return values in the range
-    # [0-31], but only the first three bits have any defined meaning.
-    if not line.endswith(('0', '1', '2', '3', '4', '5', '6', '7')):
+    match = GPERF_LINE.fullmatch(line)
+    if not match:
+      if line[-3:-1] != ', ':
+        raise InputError('Expected "domainname, <digit>", found "%s"' % line)
+      # Technically the DAFSA format can support return values in the range
+      # [0-31], but only the first three bits have any defined meaning.
       raise InputError('Expected value to be in the range of 0-7, found "%s"' %
                        line[-1])
+    words.append((match[1], match[2]))
   if reverse:
-    return [line[-4::-1] + line[-1] for line in lines]
+    return [domain[::-1] + value for domain, value in words]
   else:
-    return [line[:-3] + line[-1] for line in lines]
+    return [domain + value for domain, value in words]
+
+
+def cache_key(words: Iterable[str]) -> str:
+  """Returns a key for the C++ code generated from a word list.
+
+  The output only depends on the set of words, so the order of the words
+  doesn't change the key. Output of a different version of this program gets
+  a different key.
+  """
+  key = hashlib.sha256()
+  with open(__file__, 'rb') as script:
+    key.update(script.read())
+  for word in sorted(set(words)):
+    key.update(word.encode('utf-8') + b'\n')
+  return key.hexdigest()
+
+
+def cached_words_to_cxx(words: Iterable[str], cache_dir: str) -> str:
+  """Generates C++ code from a word list unless it is found in `cache_dir`."""
+  path = os.path.join(cache_dir, cache_key(words))
+  try:
+    with open(path) as cached:
+      return cached.read()
+  except FileNotFoundError:
+    pass
+  text = words_to_cxx(words)
+  os.makedirs(cache_dir, exist_ok=True)
+  # Write to a temporary file first so that a concurrent run never reads a
+  # partially written file.
+  fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+  try:
+    with os.fdopen(fd, 'w') as temp:
+      temp.write(text)
+    # mkstemp creates the file readable by the owner only, but the cache may
+    # be shared with other users.
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+  except BaseException:
+    os.unlink(temp_path)
+    raise
+  return text
 
 
 def main() -> int:
@@ -494,8 +739,16 @@ def main() -> int:
                       default=sys.stdin)
   parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'),
                       default=sys.stdout)
+  parser.add_argument('--cache-dir',
+                      help='Directory where generated code is kept and '
+                      'reused for an equal word list. Meant for manual '
+                      'runs, the build does not pass it.')
   args = parser.parse_args()
-  args.outfile.write(words_to_cxx(parse_gperf(args.infile, args.reverse)))
+  words = parse_gperf(args.infile, args.reverse)
+  if args.cache_dir:
+    args.outfile.write(cached_words_to_cxx(words, args.cache_dir))
+  else:
+    args.outfile.write(words_to_cxx(words))
   return 0
 
 
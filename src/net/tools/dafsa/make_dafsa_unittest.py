@@ -4,7 +4,9 @@
 # found in the LICENSE file.
 
 
+import os
 import sys
+import tempfile
 import unittest
 import make_dafsa
 
@@ -105,34 +107,123 @@ class ToDafsaTest(unittest.TestCase):
     words4 = ( 'a' + chr(0x80) + '1', )
     self.assertRaises(make_dafsa.InputError, make_dafsa.to_dafsa, words4)
 
+  def testPrintableASCII(self):
+    """Tests the first and last printable characters are accepted."""
+    words = [ chr(0x20) + chr(0x7F) + '1' ]
+    node3 = make_dafsa.InteriorNode( chr(1), [ None ] )
+    node2 = make_dafsa.InteriorNode( chr(0x7F), [ node3 ] )
+    node1 = make_dafsa.InteriorNode( chr(0x20), [ node2 ] )
+    source = [ node1 ]
+    self.assertEqual(make_dafsa.to_dafsa(words), source)
+
   def testChar(self):
     """Tests a DAFSA can be created from a single character domain name."""
     words = [ 'a0' ]
-    node2 = ( chr(0), [ None ] )
-    node1 = ( 'a', [ node2 ] )
+    node2 = make_dafsa.InteriorNode( chr(0), [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.to_dafsa(words), source)
 
   def testChars(self):
     """Tests a DAFSA can be created from a multi character domain name."""
     words = [ 'ab0' ]
-    node3 = ( chr(0), [ None ] )
-    node2 = ( 'b', [ node3 ] )
-    node1 = ( 'a', [ node2 ] )
+    node3 = make_dafsa.InteriorNode( chr(0), [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.to_dafsa(words), source)
 
   def testWords(self):
     """Tests a DAFSA can be created from a sequence of domain names."""
     words = [ 'a0', 'b1' ]
-    node4 = ( chr(1), [ None ] )
-    node3 = ( 'b', [ node4 ] )
-    node2 = ( chr(0), [ None ] )
-    node1 = ( 'a', [ node2 ] )
+    node4 = make_dafsa.InteriorNode( chr(1), [ None ] )
+    node3 = make_dafsa.InteriorNode( 'b', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( chr(0), [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source = [ node1, node3 ]
     self.assertEqual(make_dafsa.to_dafsa(words), source)
 
 
+class BuildMinimalTest(unittest.TestCase):
+  def testEmptyInput(self):
+    """Tests exception is thrown at empty input."""
+    words = ()
+    self.assertRaises(make_dafsa.InputError, make_dafsa.build_minimal, words)
+
+  def testNonASCII(self):
+    """Tests exception is thrown if illegal characters are used."""
+    words1 = ( chr(0x1F) + 'a1', )
+    self.assertRaises(make_dafsa.InputError, make_dafsa.build_minimal, words1)
+
+    words2 = ( 'a' + chr(0x80) + '1', )
+    self.assertRaises(make_dafsa.InputError, make_dafsa.build_minimal, words2)
+
+  def testSortedWords(self):
+    """Tests words are added in sorted order with shared prefixes."""
+
+    #   'a' -> chr(0)
+    #   /
+    # 'b'
+    #   \
+    #   chr(1)
+
+    words = [ 'ba0', 'b1' ]
+    node4 = make_dafsa.InteriorNode( chr(0), [ None ] )
+    node3 = make_dafsa.InteriorNode( 'a', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( chr(1), [ None ] )
+    node1 = make_dafsa.InteriorNode( 'b', [ node2, node3 ] )
+    source = [ node1 ]
+    self.assertEqual(make_dafsa.build_minimal(words), source)
+
+  def testDuplicateWords(self):
+    """Tests a word that is repeated is only added once."""
+    words = [ 'a0', 'a0' ]
+    node2 = make_dafsa.InteriorNode( chr(0), [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
+    source = [ node1 ]
+    self.assertEqual(make_dafsa.build_minimal(words), source)
+
+  def testJoinSuffixes(self):
+    """Tests suffixes are joined."""
+
+    # 'a' -> 'c' -> chr(0)     'a'
+    #                            \
+    #                     =>     'c' -> chr(0)
+    #                            /
+    # 'b' -> 'c' -> chr(0)     'b'
+
+    words = [ 'bc0', 'ac0' ]
+    source = make_dafsa.build_minimal(words)
+    self.assertEqual(len(source), 2)
+    self.assertIs(source[0].children[0], source[1].children[0])
+    self.assertEqual(make_dafsa.to_words(source[0]), [ 'ac' + chr(0) ])
+    self.assertEqual(make_dafsa.to_words(source[1]), [ 'bc' + chr(0) ])
+
+  def testMatchesJoinSuffixes(self):
+    """Tests the same graph is built as by joining suffixes twice."""
+    words = [ 'aa1', 'bbb2', 'baa1', 'bba1', 'ab2' ]
+    source1 = make_dafsa.to_dafsa(words)
+    for fun in (make_dafsa.reverse, make_dafsa.join_suffixes,
+                make_dafsa.reverse, make_dafsa.join_suffixes):
+      source1 = fun(source1)
+    source2 = make_dafsa.build_minimal(words)
+    self.assertEqual(len(make_dafsa.top_sort(source1)),
+                     len(make_dafsa.top_sort(source2)))
+    self.assertEqual(sorted(word for node in source1
+                            for word in make_dafsa.to_words(node)),
+                     sorted(word for node in source2
+                            for word in make_dafsa.to_words(node)))
+
+  def testAlreadyJoined(self):
+    """Tests joining suffixes again does not merge any more nodes."""
+    words = [ 'aa1', 'bbb2', 'baa1', 'bba1', 'ab2', 'b2' ]
+    source1 = make_dafsa.build_minimal(words)
+    source2 = make_dafsa.join_suffixes(source1)
+    self.assertEqual(source1, source2)
+    self.assertEqual(len(make_dafsa.top_sort(source1)),
+                     len(make_dafsa.top_sort(source2)))
+
+
 class ToWordsTest(unittest.TestCase):
   def testSink(self):
     """Tests the sink is exapnded to a list with an empty string."""
@@ -145,7 +236,7 @@ class ToWordsTest(unittest.TestCase):
 
     # 'ab' -> [ 'ab' ]
 
-    node1 = ( 'ab', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ None ] )
     words = [ 'ab' ]
     self.assertEqual(make_dafsa.to_words(node1), words)
 
@@ -154,8 +245,8 @@ class ToWordsTest(unittest.TestCase):
 
     # 'ab' -> 'cd' => [ 'abcd' ]
 
-    node2 = ( 'cd', [ None ] )
-    node1 = ( 'ab', [ node2 ] )
+    node2 = make_dafsa.InteriorNode( 'cd', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ node2 ] )
     words = [ 'abcd' ]
     self.assertEqual(make_dafsa.to_words(node1), words)
 
@@ -166,8 +257,8 @@ class ToWordsTest(unittest.TestCase):
     #   \       => [ 'ab', 'a' ]
     #  {sink}
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, None ] )
     words = [ 'ab', 'a' ]
     self.assertEqual(make_dafsa.to_words(node1), words)
 
@@ -180,10 +271,10 @@ class ToWordsTest(unittest.TestCase):
     #   \  /
     #   'ef'
 
-    node4 = ( 'gh', [ None ] )
-    node3 = ( 'ef', [ node4 ] )
-    node2 = ( 'cd', [ node4 ] )
-    node1 = ( 'ab', [ node2, node3 ] )
+    node4 = make_dafsa.InteriorNode( 'gh', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'ef', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'cd', [ node4 ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ node2, node3 ] )
     words = [ 'abcdgh', 'abefgh' ]
     self.assertEqual(make_dafsa.to_words(node1), words)
 
@@ -194,7 +285,7 @@ class JoinLabelsTest(unittest.TestCase):
 
     # 'a'  =>  'a'
 
-    node1 = ( 'a', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ None ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_labels(source), source)
 
@@ -205,8 +296,8 @@ class JoinLabelsTest(unittest.TestCase):
     #   \       =>    \
     #  {sink}        {sink}
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, None ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_labels(source), source)
 
@@ -215,10 +306,10 @@ class JoinLabelsTest(unittest.TestCase):
 
     # 'a' -> 'b'  =>  'ab'
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source1 = [ node1 ]
-    node3 = ( 'ab', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'ab', [ None ] )
     source2 = [ node3 ]
     self.assertEqual(make_dafsa.join_labels(source1), source2)
 
@@ -227,10 +318,10 @@ class JoinLabelsTest(unittest.TestCase):
 
     # 'ab' -> 'cd'  =>  'abcd'
 
-    node2 = ( 'cd', [ None ] )
-    node1 = ( 'ab', [ node2 ] )
+    node2 = make_dafsa.InteriorNode( 'cd', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ node2 ] )
     source1 = [ node1 ]
-    node3 = ( 'abcd', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'abcd', [ None ] )
     source2 = [ node3 ]
     self.assertEqual(make_dafsa.join_labels(source1), source2)
 
@@ -243,9 +334,9 @@ class JoinLabelsTest(unittest.TestCase):
     #   \         \
     #   'c'       'c'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_labels(source), source)
 
@@ -258,9 +349,9 @@ class JoinLabelsTest(unittest.TestCase):
     #   /          /
     # 'b'        'b'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ node3 ] )
-    node1 = ( 'a', [ node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node3 ] )
     source = [ node1, node2 ]
     self.assertEqual(make_dafsa.join_labels(source), source)
 
@@ -273,16 +364,16 @@ class JoinLabelsTest(unittest.TestCase):
     #          \                  \
     #          'e' -> 'f'         'ef'
 
-    node6 = ( 'f', [ None ] )
-    node5 = ( 'e', [ node6 ] )
-    node4 = ( 'd', [ None ] )
-    node3 = ( 'c', [ node4 ] )
-    node2 = ( 'b', [ node3, node5 ] )
-    node1 = ( 'a', [ node2 ] )
+    node6 = make_dafsa.InteriorNode( 'f', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'e', [ node6 ] )
+    node4 = make_dafsa.InteriorNode( 'd', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3, node5 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source1 = [ node1 ]
-    node9 = ( 'ef', [ None ] )
-    node8 = ( 'cd', [ None ] )
-    node7 = ( 'ab', [ node8, node9 ] )
+    node9 = make_dafsa.InteriorNode( 'ef', [ None ] )
+    node8 = make_dafsa.InteriorNode( 'cd', [ None ] )
+    node7 = make_dafsa.InteriorNode( 'ab', [ node8, node9 ] )
     source2 = [ node7 ]
     self.assertEqual(make_dafsa.join_labels(source1), source2)
 
@@ -295,19 +386,39 @@ class JoinLabelsTest(unittest.TestCase):
     #          /                  /
     # 'c' -> 'd'               'cd'
 
-    node6 = ( 'f', [ None ] )
-    node5 = ( 'e', [ node6 ] )
-    node4 = ( 'd', [ node5 ] )
-    node3 = ( 'c', [ node4 ] )
-    node2 = ( 'b', [ node5 ] )
-    node1 = ( 'a', [ node2 ] )
+    node6 = make_dafsa.InteriorNode( 'f', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'e', [ node6 ] )
+    node4 = make_dafsa.InteriorNode( 'd', [ node5 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node5 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source1 = [ node1, node3 ]
-    node9 = ( 'ef', [ None ] )
-    node8 = ( 'cd', [ node9 ] )
-    node7 = ( 'ab', [ node9 ] )
+    node9 = make_dafsa.InteriorNode( 'ef', [ None ] )
+    node8 = make_dafsa.InteriorNode( 'cd', [ node9 ] )
+    node7 = make_dafsa.InteriorNode( 'ab', [ node9 ] )
     source2 = [ node7, node8 ]
     self.assertEqual(make_dafsa.join_labels(source1), source2)
 
+  def testSortedOrder(self):
+    """Tests the joined nodes are returned in topological sort order."""
+
+    # 'a' -> 'b'               'ab'
+    #          \                  \
+    #          'e' -> 'f'  =>     'ef'
+    #          /                  /
+    # 'c' -> 'd'               'cd'
+
+    node6 = make_dafsa.InteriorNode( 'f', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'e', [ node6 ] )
+    node4 = make_dafsa.InteriorNode( 'd', [ node5 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node5 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
+    source = [ node1, node3 ]
+    joined, nodes = make_dafsa.join_labels_sorted(source)
+    self.assertEqual([ id(node) for node in nodes ],
+                     [ id(node) for node in make_dafsa.top_sort(joined) ])
+
 
 class JoinSuffixesTest(unittest.TestCase):
   def testSingleLabel(self):
@@ -315,7 +426,7 @@ class JoinSuffixesTest(unittest.TestCase):
 
     # 'a'  =>  'a'
 
-    node1 = ( 'a', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ None ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_suffixes(source), source)
 
@@ -326,8 +437,8 @@ class JoinSuffixesTest(unittest.TestCase):
     #   \       =>    \
     #  {sink}        {sink}
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, None ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_suffixes(source), source)
 
@@ -340,9 +451,9 @@ class JoinSuffixesTest(unittest.TestCase):
     #   \         \
     #   'c'       'c'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.join_suffixes(source), source)
 
@@ -356,9 +467,9 @@ class JoinSuffixesTest(unittest.TestCase):
     #   /          /
     # 'b'        'b'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ node3 ] )
-    node1 = ( 'a', [ node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node3 ] )
     source = [ node1, node2 ]
     self.assertEqual(make_dafsa.join_suffixes(source), source)
 
@@ -374,9 +485,9 @@ class JoinSuffixesTest(unittest.TestCase):
     # The picture above should shows that the new version should have just one
     # instance of the node with label 'a'.
 
-    node3 = ( 'a', [ None ] )
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'a', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ None ] )
     source1 = [ node1, node2, node3 ]
     source2 = make_dafsa.join_suffixes(source1)
 
@@ -394,17 +505,17 @@ class JoinSuffixesTest(unittest.TestCase):
     #                   /
     # 'b' -> 'c'      'b'
 
-    node4 = ( 'c', [ None ] )
-    node3 = ( 'b', [ node4 ] )
-    node2 = ( 'c', [ None ] )
-    node1 = ( 'a', [ node2 ] )
+    node4 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'b', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source1 = [ node1, node3 ]
     source2 = make_dafsa.join_suffixes(source1)
 
     # Both versions should expand to the same content.
     self.assertEqual(source1, source2)
     # But the new version should have just one tail.
-    self.assertIs(source2[0][1][0], source2[1][1][0])
+    self.assertIs(source2[0].children[0], source2[1].children[0])
 
   def testMakeRecursiveTrie(self):
     """Tests recursive suffix join."""
@@ -423,24 +534,25 @@ class JoinSuffixesTest(unittest.TestCase):
     #                         /
     # 'd' -> 'f' -> 'g'     'd'
 
-    node7 = ( 'g', [ None ] )
-    node6 = ( 'f', [ node7 ] )
-    node5 = ( 'e', [ node7 ] )
-    node4 = ( 'd', [ node6 ] )
-    node3 = ( 'c', [ node6 ] )
-    node2 = ( 'b', [ node5 ] )
-    node1 = ( 'a', [ node5 ] )
+    node7 = make_dafsa.InteriorNode( 'g', [ None ] )
+    node6 = make_dafsa.InteriorNode( 'f', [ node7 ] )
+    node5 = make_dafsa.InteriorNode( 'e', [ node7 ] )
+    node4 = make_dafsa.InteriorNode( 'd', [ node6 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ node6 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node5 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node5 ] )
     source1 = [ node1, node2, node3, node4 ]
     source2 = make_dafsa.join_suffixes(source1)
 
     # Both versions should expand to the same content.
     self.assertEqual(source1, source2)
     # But the new version should have just one 'e'.
-    self.assertIs(source2[0][1][0], source2[1][1][0])
+    self.assertIs(source2[0].children[0], source2[1].children[0])
     # And one 'f'.
-    self.assertIs(source2[2][1][0], source2[3][1][0])
+    self.assertIs(source2[2].children[0], source2[3].children[0])
     # And one 'g'.
-    self.assertIs(source2[0][1][0][1][0], source2[2][1][0][1][0])
+    self.assertIs(source2[0].children[0].children[0],
+                  source2[2].children[0].children[0])
 
   def testMakeDiamond(self):
     """Test we can join suffixes of a trie."""
@@ -451,18 +563,19 @@ class JoinSuffixesTest(unittest.TestCase):
     #   \                 \ /
     #   'c' -> 'd'        'c'
 
-    node5 = ( 'd', [ None ] )
-    node4 = ( 'c', [ node5 ] )
-    node3 = ( 'd', [ None ] )
-    node2 = ( 'b', [ node3 ] )
-    node1 = ( 'a', [ node2, node4 ] )
+    node5 = make_dafsa.InteriorNode( 'd', [ None ] )
+    node4 = make_dafsa.InteriorNode( 'c', [ node5 ] )
+    node3 = make_dafsa.InteriorNode( 'd', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node4 ] )
     source1 = [ node1 ]
     source2 = make_dafsa.join_suffixes(source1)
 
     # Both versions should expand to the same content.
     self.assertEqual(source1, source2)
     # But the new version should have just one 'd'.
-    self.assertIs(source2[0][1][0][1][0], source2[0][1][1][1][0])
+    self.assertIs(source2[0].children[0].children[0],
+                  source2[0].children[1].children[0])
 
   def testJoinOneChild(self):
     """Tests that we can join some children but not all."""
@@ -479,19 +592,19 @@ class JoinSuffixesTest(unittest.TestCase):
     #   \            \
     #   'e'          'e'
 
-    node6 = ( 'e', [ None ] )
-    node5 = ( 'c', [ None ] )
-    node4 = ( 'b', [ node5, node6 ] )
-    node3 = ( 'd', [ None ] )
-    node2 = ( 'c', [ None ] )
-    node1 = ( 'a', [ node2, node3 ] )
+    node6 = make_dafsa.InteriorNode( 'e', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node4 = make_dafsa.InteriorNode( 'b', [ node5, node6 ] )
+    node3 = make_dafsa.InteriorNode( 'd', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
     source1 = [ node1, node4 ]
     source2 = make_dafsa.join_suffixes(source1)
 
     # Both versions should expand to the same content.
     self.assertEqual(source1, source2)
     # But the new version should have just one 'c'.
-    self.assertIs(source2[0][1][0], source2[1][1][0])
+    self.assertIs(source2[0].children[0], source2[1].children[0])
 
 
 class ReverseTest(unittest.TestCase):
@@ -500,7 +613,7 @@ class ReverseTest(unittest.TestCase):
 
     # 'a'  =>  'a'
 
-    node1 = ( 'a', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ None ] )
     source = [ node1 ]
     self.assertEqual(make_dafsa.reverse(source), source)
 
@@ -509,9 +622,9 @@ class ReverseTest(unittest.TestCase):
 
     # 'ab'  =>  'ba'
 
-    node1 = ( 'ab', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ None ] )
     source1 = [ node1 ]
-    node2 = ( 'ba', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'ba', [ None ] )
     source2 = [ node2 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -520,11 +633,11 @@ class ReverseTest(unittest.TestCase):
 
     # 'a' -> 'b'  =>  'b' -> 'a'
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
     source1 = [ node1 ]
-    node4 = ( 'a', [ None ] )
-    node3 = ( 'b', [ node4 ] )
+    node4 = make_dafsa.InteriorNode( 'a', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'b', [ node4 ] )
     source2 = [ node3 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -535,11 +648,11 @@ class ReverseTest(unittest.TestCase):
     #   \       =>         /
     #  {sink}        ------
 
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, None ] )
     source1 = [ node1 ]
-    node4 = ( 'a', [ None ] )
-    node3 = ( 'b', [ node4 ] )
+    node4 = make_dafsa.InteriorNode( 'a', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'b', [ node4 ] )
     source2 = [ node3, node4 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -552,13 +665,13 @@ class ReverseTest(unittest.TestCase):
     #   \         /
     #   'c'     'c'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ None ] )
-    node1 = ( 'a', [ node2, node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
     source1 = [ node1 ]
-    node6 = ( 'a', [ None ] )
-    node5 = ( 'c', [ node6 ] )
-    node4 = ( 'b', [ node6 ] )
+    node6 = make_dafsa.InteriorNode( 'a', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'c', [ node6 ] )
+    node4 = make_dafsa.InteriorNode( 'b', [ node6 ] )
     source2 = [ node4, node5 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -571,13 +684,13 @@ class ReverseTest(unittest.TestCase):
     #   /          \
     # 'b'          'b'
 
-    node3 = ( 'c', [ None ] )
-    node2 = ( 'b', [ node3 ] )
-    node1 = ( 'a', [ node3 ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node3 ] )
     source1 = [ node1, node2 ]
-    node6 = ( 'b', [ None ] )
-    node5 = ( 'a', [ None ] )
-    node4 = ( 'c', [ node5, node6 ] )
+    node6 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node5 = make_dafsa.InteriorNode( 'a', [ None ] )
+    node4 = make_dafsa.InteriorNode( 'c', [ node5, node6 ] )
     source2 = [ node4 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -590,15 +703,15 @@ class ReverseTest(unittest.TestCase):
     #   \  /           \  /
     #   'ef'           'fe'
 
-    node4 = ( 'gh', [ None ] )
-    node3 = ( 'ef', [ node4 ] )
-    node2 = ( 'cd', [ node4 ] )
-    node1 = ( 'ab', [ node2, node3 ] )
+    node4 = make_dafsa.InteriorNode( 'gh', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'ef', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'cd', [ node4 ] )
+    node1 = make_dafsa.InteriorNode( 'ab', [ node2, node3 ] )
     source1 = [ node1 ]
-    node8 = ( 'ba', [ None ] )
-    node7 = ( 'fe', [ node8 ] )
-    node6 = ( 'dc', [ node8 ] )
-    node5 = ( 'hg', [ node6, node7 ] )
+    node8 = make_dafsa.InteriorNode( 'ba', [ None ] )
+    node7 = make_dafsa.InteriorNode( 'fe', [ node8 ] )
+    node6 = make_dafsa.InteriorNode( 'dc', [ node8 ] )
+    node5 = make_dafsa.InteriorNode( 'hg', [ node6, node7 ] )
     source2 = [ node5 ]
     self.assertEqual(make_dafsa.reverse(source1), source2)
 
@@ -618,7 +731,7 @@ class TopSortTest(unittest.TestCase):
 
     # 'a'  =>  [ 'a' ]
 
-    node1 = ( 'a', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ None ] )
     source = [ node1 ]
     nodes = [ node1 ]
     self.assertEqual(make_dafsa.top_sort(source), nodes)
@@ -632,28 +745,52 @@ class TopSortTest(unittest.TestCase):
     #   \ /
     #   'c'
 
-    node4 = ( 'd', [ None ] )
-    node3 = ( 'c', [ node4 ] )
-    node2 = ( 'b', [ node4 ] )
-    node1 = ( 'a', [ node2, node3 ] )
+    node4 = make_dafsa.InteriorNode( 'd', [ None ] )
+    node3 = make_dafsa.InteriorNode( 'c', [ node4 ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node4 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
     source = [ node1 ]
     nodes = make_dafsa.top_sort(source)
     self.assertLess(nodes.index(node1), nodes.index(node2))
     self.assertLess(nodes.index(node2), nodes.index(node4))
     self.assertLess(nodes.index(node3), nodes.index(node4))
 
+  def testSourceChild(self):
+    """Tests a node that is both a source and a child is sorted after its
+    parent."""
+
+    # 'a' -> 'b'
+    #        /
+    #   {source}
+
+    node2 = make_dafsa.InteriorNode( 'b', [ None ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2 ] )
+    source = [ node2, node1 ]
+    nodes = [ node1, node2 ]
+    self.assertEqual(make_dafsa.top_sort(source), nodes)
+
+  def testRepeated(self):
+    """Tests a DAFSA can be sorted again with the same result."""
+    node3 = make_dafsa.InteriorNode( 'c', [ None ] )
+    node2 = make_dafsa.InteriorNode( 'b', [ node3 ] )
+    node1 = make_dafsa.InteriorNode( 'a', [ node2, node3 ] )
+    source = [ node1 ]
+    nodes = make_dafsa.top_sort(source)
+    self.assertEqual(nodes, [ node1, node2, node3 ])
+    self.assertEqual(make_dafsa.top_sort(source), nodes)
+
 
 class EncodePrefixTest(unittest.TestCase):
   def testChar(self):
     """Tests to encode a single character prefix."""
     label = 'a'
-    bytes = [ ord('a') ]
+    bytes = b'a'
     self.assertEqual(make_dafsa.encode_prefix(label), bytes)
 
   def testChars(self):
     """Tests to encode a multi character prefix."""
     label = 'ab'
-    bytes = [ ord('b'), ord('a') ]
+    bytes = b'ba'
     self.assertEqual(make_dafsa.encode_prefix(label), bytes)
 
 
@@ -661,101 +798,128 @@ class EncodeLabelTest(unittest.TestCase):
   def testChar(self):
     """Tests to encode a single character label."""
     label = 'a'
-    bytes = [ ord('a') + 0x80 ]
+    bytes = bytearray([ ord('a') + 0x80 ])
     self.assertEqual(make_dafsa.encode_label(label), bytes)
 
   def testChars(self):
     """Tests to encode a multi character label."""
     label = 'ab'
-    bytes = [ ord('b') + 0x80, ord('a') ]
+    bytes = bytearray([ ord('b') + 0x80, ord('a') ])
     self.assertEqual(make_dafsa.encode_label(label), bytes)
 
 
+class LinkSizeTest(unittest.TestCase):
+  def testSizes(self):
+    """Tests the size of links at the limits of each size."""
+    self.assertEqual(make_dafsa.link_size(1), 1)
+    self.assertEqual(make_dafsa.link_size((1 << 6) - 1), 1)
+    self.assertEqual(make_dafsa.link_size(1 << 6), 2)
+    self.assertEqual(make_dafsa.link_size((1 << 13) - 1), 2)
+    self.assertEqual(make_dafsa.link_size(1 << 13), 3)
+    self.assertEqual(make_dafsa.link_size((1 << 21) - 1), 3)
+
+
 class EncodeLinksTest(unittest.TestCase):
   def testEndLabel(self):
     """Tests to encode link to the sink."""
     children = [ None ]
-    offsets = {}
     bytes = 0
-    output = []
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = b''
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testOneByteOffset(self):
     """Tests to encode a single one byte offset."""
-    node = ( '', [ None ] )
+    node = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node ]
-    offsets = { id(node) : 2 }
+    node.offset = 2
     bytes = 5
-    output = [ 132 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 132 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testOneByteOffsets(self):
     """Tests to encode a sequence of one byte offsets."""
-    node1 = ( '', [ None ] )
-    node2 = ( '', [ None ] )
+    node1 = make_dafsa.InteriorNode( '', [ None ] )
+    node2 = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node1, node2 ]
-    offsets = { id(node1) : 2, id(node2) : 1 }
+    node1.offset = 2
+    node2.offset = 1
     bytes = 5
-    output = [ 129, 5 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 129, 5 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testTwoBytesOffset(self):
     """Tests to encode a single two byte offset."""
-    node = ( '', [ None ] )
+    node = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node ]
-    offsets = { id(node) : 2 }
+    node.offset = 2
     bytes = 1005
-    output = [ 237, 195]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 237, 195])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
+                      output)
+
+  def testTwoBytesOffsetOverOneByte(self):
+    """Tests the larger size is used when a link fits in either size."""
+    node = make_dafsa.InteriorNode( '', [ None ] )
+    children = [ node ]
+    node.offset = 0
+    bytes = 62
+    output = bytearray([ 64, 192 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testTwoBytesOffsets(self):
     """Tests to encode a sequence of two byte offsets."""
-    node1 = ( '', [ None ] )
-    node2 = ( '', [ None ] )
-    node3 = ( '', [ None ] )
+    node1 = make_dafsa.InteriorNode( '', [ None ] )
+    node2 = make_dafsa.InteriorNode( '', [ None ] )
+    node3 = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node1, node2, node3 ]
-    offsets = { id(node1) : 1002, id(node2) : 2, id(node3) : 2002 }
+    node1.offset = 1002
+    node2.offset = 2
+    node3.offset = 2002
     bytes = 3005
-    output = [ 232, 195, 232, 67, 241, 67 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 232, 195, 232, 67, 241, 67 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testThreeBytesOffset(self):
     """Tests to encode a single three byte offset."""
-    node = ( '', [ None ] )
+    node = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node ]
-    offsets = { id(node) : 2 }
+    node.offset = 2
     bytes = 100005
-    output = [ 166, 134, 225 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 166, 134, 225 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testThreeBytesOffsets(self):
     """Tests to encode a sequence of three byte offsets."""
-    node1 = ( '', [ None ] )
-    node2 = ( '', [ None ] )
-    node3 = ( '', [ None ] )
+    node1 = make_dafsa.InteriorNode( '', [ None ] )
+    node2 = make_dafsa.InteriorNode( '', [ None ] )
+    node3 = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node1, node2, node3 ]
-    offsets = { id(node1) : 100002, id(node2) : 2, id(node3) : 200002 }
+    node1.offset = 100002
+    node2.offset = 2
+    node3.offset = 200002
     bytes = 300005
-    output = [ 160, 134, 225, 160, 134, 97, 172, 134, 97 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 160, 134, 225, 160, 134, 97, 172, 134, 97 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
   def testOneTwoThreeBytesOffsets(self):
     """Tests to encode offsets of different sizes."""
-    node1 = ( '', [ None ] )
-    node2 = ( '', [ None ] )
-    node3 = ( '', [ None ] )
+    node1 = make_dafsa.InteriorNode( '', [ None ] )
+    node2 = make_dafsa.InteriorNode( '', [ None ] )
+    node3 = make_dafsa.InteriorNode( '', [ None ] )
     children = [ node1, node2, node3 ]
-    offsets = { id(node1) : 10003, id(node2) : 10002, id(node3) : 100002 }
+    node1.offset = 10003
+    node2.offset = 10002
+    node3.offset = 100002
     bytes = 300005
-    output = [ 129, 143, 95, 97, 74, 13, 99 ]
-    self.assertEqual(make_dafsa.encode_links(children, offsets, bytes),
+    output = bytearray([ 129, 143, 95, 97, 74, 13, 99 ])
+    self.assertEqual(make_dafsa.encode_links(children, bytes),
                       output)
 
 
@@ -763,7 +927,7 @@ class ExamplesTest(unittest.TestCase):
   def testExample1(self):
     """Tests Example 1 from make_dafsa.py."""
     infile = [ '%%', 'aa, 1', 'a, 2', '%%' ]
-    bytes = [ 0x81, 0xE1, 0x02, 0x81, 0x82, 0x61, 0x81 ]
+    bytes = [ 0x81, 0xE1, 0x02, 0x82, 0x61, 0x81, 0x82 ]
     outfile = make_dafsa.to_cxx(bytes)
     self.assertEqual(make_dafsa.words_to_cxx(make_dafsa.parse_gperf(
       infile, False)), outfile)
@@ -771,12 +935,60 @@ class ExamplesTest(unittest.TestCase):
   def testExample2(self):
     """Tests Example 2 from make_dafsa.py."""
     infile = [ '%%', 'aa, 1', 'bbb, 2', 'baa, 1', '%%' ]
-    bytes = [ 0x02, 0x83, 0xE2, 0x02, 0x83, 0x61, 0x61, 0x81, 0x62, 0x62,
-              0x82 ]
+    bytes = [ 0x02, 0x86, 0xE2, 0x02, 0x83, 0x62, 0x62, 0x82, 0x61, 0x61,
+              0x81 ]
     outfile = make_dafsa.to_cxx(bytes)
     self.assertEqual(make_dafsa.words_to_cxx(make_dafsa.parse_gperf(
       infile, False)), outfile)
 
 
+class LongWordTest(unittest.TestCase):
+  def testLongWord(self):
+    """Tests a word longer than the recursion limit can be encoded."""
+    length = sys.getrecursionlimit() + 100
+    words = [ 'a' * length + '1' ]
+    source = make_dafsa.to_dafsa(words)
+    for fun in (make_dafsa.reverse, make_dafsa.join_suffixes,
+                make_dafsa.reverse, make_dafsa.join_suffixes,
+                make_dafsa.join_labels):
+      source = fun(source)
+    self.assertEqual(make_dafsa.to_words(source[0]), [ 'a' * length + chr(1) ])
+    self.assertEqual(len(make_dafsa.top_sort(source)), 1)
+    # One link from the source followed by the label.
+    self.assertEqual(len(make_dafsa.encode(source)), length + 2)
+
+  def testLongWordToCxx(self):
+    """Tests C++ code can be generated for a word longer than the recursion
+    limit."""
+    length = sys.getrecursionlimit() + 100
+    words = [ 'a' * length + '1' ]
+    outfile = make_dafsa.words_to_cxx(words)
+    self.assertIn('kDafsa[%d]' % (length + 2), outfile)
+    self.assertIn('0x81, 0x61, 0x61,', outfile)
+
+
+class CacheTest(unittest.TestCase):
+  def testCacheKey(self):
+    """Tests the key only depends on the set of words."""
+    key = make_dafsa.cache_key([ 'aa1', 'a2' ])
+    self.assertEqual(make_dafsa.cache_key([ 'a2', 'aa1', 'a2' ]), key)
+    self.assertNotEqual(make_dafsa.cache_key([ 'aa1', 'a1' ]), key)
+
+  def testCachedOutput(self):
+    """Tests generated code is stored in and read from the cache."""
+    words = [ 'aa1', 'a2' ]
+    with tempfile.TemporaryDirectory() as cache_dir:
+      outfile = make_dafsa.cached_words_to_cxx(words, cache_dir)
+      self.assertEqual(outfile, make_dafsa.words_to_cxx(words))
+      key = make_dafsa.cache_key(words)
+      self.assertEqual(os.listdir(cache_dir), [ key ])
+      path = os.path.join(cache_dir, key)
+      self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+      with open(path, 'w') as cached:
+        cached.write('cached')
+      self.assertEqual(make_dafsa.cached_words_to_cxx(words, cache_dir),
+                       'cached')
+
+
 if __name__ == '__main__':
   unittest.main()